@@ -1,12 +1,20 @@
+import operator
 import warnings
 from collections import deque, defaultdict
-from typing import List, Tuple, Iterable, Union, Optional
+from functools import partial
+from itertools import chain
+from typing import Dict, List, Tuple, Iterable, Union, Optional
 
-import numpy as np
 import torch
 import torch.nn as nn
 from torch import Tensor
 
+try:
+    import torch.fx
+except ImportError:
+    # torch.fx is only available from PyTorch 1.8 on
+    pass
+
 from ..modules.base import InvertibleModule
 
 
@@ -74,33 +82,39 @@ class Node:
 
     def parse_inputs(self, inputs: Union["Node", Tuple["Node", int],
                                          Iterable[Tuple["Node", int]]]) \
-            -> List[Tuple["Node", int]]:
+            -> Tuple[Tuple["Node", int], ...]:
         """
         Converts specified inputs to a node to a canonical format.
         Inputs can be specified in three forms:
 
         - a single node, then this nodes first output is taken as input
         - a single tuple (node, idx), specifying output idx of node
-        - a list of tuples [(node, idx)], each specifying output idx of node
+        - a list of nodes or tuples [(node, idx)], each specifying output idx
+          of node (a plain node stands for its first output)
 
-        All such formats are converted to the last format.
+        All such formats are converted to a new tuple of (node, idx) tuples.
         """
-        if isinstance(inputs, (list, tuple)):
-            if len(inputs) == 0:
-                return inputs
-            elif isinstance(inputs[0], (list, tuple)):
-                return inputs
-            elif len(inputs) == 2:
-                return [inputs, ]
+        if isinstance(inputs, Node):
+            return (inputs, 0),
+        if not isinstance(inputs, (list, tuple)):
+            raise ValueError(f"Received object of invalid type "
+                             f"({type(inputs)}) as input for node "
+                             f"'{self.name}'.")
+        if len(inputs) == 2 and isinstance(inputs[0], Node) \
+                and not isinstance(inputs[1], (Node, list, tuple)):
+            inputs = inputs,
+
+        parsed_inputs = []
+        for inp in inputs:
+            if isinstance(inp, Node):
+                parsed_inputs.append((inp, 0))
+            elif isinstance(inp, (list, tuple)) and len(inp) == 2 \
+                    and isinstance(inp[0], Node):
+                parsed_inputs.append((inp[0], inp[1]))
             else:
                 raise RuntimeError(
                     f"Cannot parse inputs provided to node '{self.name}'.")
-        else:
-            if not isinstance(inputs, Node):
-                raise ValueError(f"Received object of invalid type "
-                                 f"({type(inputs)}) as input for node "
-                                 f"'{self.name}'.")
-            return [(inputs, 0), ]
+        return tuple(parsed_inputs)
 
     def __str__(self):
         module_hint = (self.module_type.__name__ if self.module_type is not None
@@ -181,9 +195,17 @@ class GraphINN(InvertibleModule):
     computed in reverse. Passing `jac` to the forward method additionally
     computes the log determinant of the (inverse) Jacobian of the forward
     (backward) pass.
+
+    With `strict=True` (default), the output of every module is checked for
+    the expected format in each forward pass. These checks only catch
+    programming errors in the modules, so they can safely be switched off
+    with `strict=False` once the net has been run successfully. Without the
+    checks, errors raised inside a module are also no longer wrapped in a
+    "`{node} encountered an error`" message naming the failing node.
     """
 
-    def __init__(self, node_list, force_tuple_output=False, verbose=False):
+    def __init__(self, node_list, force_tuple_output=False, verbose=False,
+                 strict=True):
         # Gather lists of input, output and condition nodes
         in_nodes = [node_list[i] for i in range(len(node_list))
                     if isinstance(node_list[i], InputNode)]
@@ -215,6 +237,10 @@ class GraphINN(InvertibleModule):
         # Only now we can set out shapes
         super().__init__(global_in_shapes, global_cond_shapes)
         self.node_list = node_list
+        # Keep the first node in case of duplicate names
+        self._node_by_name = {}
+        for node in node_list:
+            self._node_by_name.setdefault(node.name, node)
 
         # Now we can store everything -- before calling super constructor,
         # nn.Module doesn't allow assigning anything
@@ -224,12 +250,91 @@ class GraphINN(InvertibleModule):
 
         self.global_out_shapes = global_out_shapes
         self.force_tuple_output = force_tuple_output
+        self.strict = strict
         self.module_list = nn.ModuleList([n.module for n in node_list
                                           if n.module is not None])
 
+        # Every value passed along an edge lives in a fixed integer slot, so
+        # that forward can work on a flat list instead of a dict
+        self._fwd_slots = self._assign_slots(rev=False)
+        self._rev_slots = self._assign_slots(rev=True)
+        self._num_slots = 1 + max(chain(self._fwd_slots.values(),
+                                        self._rev_slots.values()))
+        self._compile_program()
+
+        # Filled by compile_forward, keyed by rev, jac and the input shapes
+        self._compiled_forwards = {}
+        # Filled by _fx_forward, keyed by rev and jac
+        self._fx_forwards = {}
+        # Set by capture_cuda_graph
+        self._cuda_graph = None
+
         if verbose:
             print(self)
 
+    def _compile_program(self):
+        """
+        Freezes the execution of the non-special nodes into one flat program
+        per direction. Each step is a tuple
+        (node, module, cond_group, in_slots, out_slots), so that running the
+        net needs no attribute or dict lookups on the nodes.
+
+        Nodes with the same conditions share a condition group, whose tuple of
+        condition tensors is built once per pass. `cond_group` is None for
+        nodes without conditions.
+        """
+        special_nodes = set(self.in_nodes + self.out_nodes
+                            + self.condition_nodes)
+        cond_groups = {}
+        fwd_program = []
+        rev_program = []
+        for node in self.node_list:
+            if node in special_nodes:
+                continue
+            if len(node.conditions) > 0:
+                cond_slots = tuple(self._fwd_slots[cond_node, 0]
+                                   for cond_node in node.conditions)
+                cond_group = cond_groups.setdefault(cond_slots,
+                                                    len(cond_groups))
+            else:
+                cond_group = None
+
+            fwd_program.append((
+                node, node.module, cond_group,
+                tuple(self._fwd_slots[key] for key in node.inputs),
+                tuple(self._fwd_slots[node, out_idx]
+                      for out_idx in range(len(node.output_dims)))))
+            rev_program.append((
+                node, node.module, cond_group,
+                tuple(self._rev_slots[key] for key in node.outputs),
+                tuple(self._rev_slots[node, in_idx]
+                      for in_idx in range(len(node.inputs)))))
+
+        self._fwd_program = tuple(fwd_program)
+        self._rev_program = tuple(rev_program[::-1])
+        self._cond_slot_groups = tuple(cond_groups)
+
+    def _assign_slots(self, rev: bool) -> Dict[Tuple[Node, int], int]:
+        """
+        Maps each (node, channel) key written during a forward (or backward)
+        pass to an integer slot. Conditions are numbered first, so that their
+        slots coincide in both directions. The final nodes only alias the
+        slot of the value they receive.
+        """
+        slots = {}
+        for condition_node in self.condition_nodes:
+            slots[condition_node, 0] = len(slots)
+        for node in self.node_list:
+            if node in self.condition_nodes:
+                continue
+            n_channels = len(node.inputs) if rev else len(node.output_dims)
+            for channel in range(n_channels):
+                slots[node, channel] = len(slots)
+        for end_node in (self.in_nodes if rev else self.out_nodes):
+            slots[end_node, 0] = slots[(end_node.outputs if rev
+                                        else end_node.inputs)[0]]
+        return slots
+
     def output_dims(self, input_dims: List[Tuple[int]]) -> List[Tuple[int]]:
         if len(self.global_out_shapes) == 1 and not self.force_tuple_output:
             raise ValueError("You can only call output_dims on a "
@@ -249,79 +354,343 @@ class GraphINN(InvertibleModule):
             warnings.warn("You called GraphINN(x=...). x is now called x_or_z, "
                           "please pass input as positional argument.")
 
+        x_or_z, c = self._parse_forward_args(x_or_z, c, rev)
+
+        if intermediate_outputs:
+            jacobian_dict = {} if jac else None
+            outs, _ = self._run_nodes(x_or_z, c, rev, jac, self.strict,
+                                      jacobian_dict)
+            slots = self._rev_slots if rev else self._fwd_slots
+            return {key: outs[slot] for key, slot in slots.items()}, \
+                   jacobian_dict
+
+        compiled_forward = None
+        if self._compiled_forwards:
+            compiled_forward = self._compiled_forwards.get(
+                self._compile_key(x_or_z, c, rev, jac))
+        if compiled_forward is not None:
+            out_list, jacobian = compiled_forward(x_or_z, c)
+        elif self.strict:
+            out_list, jacobian = self._forward_impl(x_or_z, c, rev, jac,
+                                                    strict=True)
+        else:
+            out_list, jacobian = self._unchecked_forward(rev, jac)(x_or_z, c)
+        if len(out_list) == 1 and not self.force_tuple_output:
+            return out_list[0], jacobian
+        else:
+            return out_list, jacobian
+
+    def compile_forward(self, example_inputs: Union[Tensor, Iterable[Tensor]],
+                        example_c: Iterable[Tensor] = None, rev: bool = False,
+                        jac: bool = True):
+        """
+        Compiles the computation of the whole net with torch.compile, for
+        inputs and conditions shaped like the given examples.
+
+        Later calls to forward with the same shapes, `rev` and `jac` (and
+        without `intermediate_outputs`) dispatch to the compiled version, all
+        other calls fall back to the regular one. Compilation itself happens
+        lazily during the first matching call.
+
+        What is compiled is the FX graph also used with `strict=False`, so
+        the module outputs are not checked. The compilation uses
+        mode="reduce-overhead", which captures CUDA graphs on the GPU. Outputs
+        may then be overwritten by the next call, so clone them if they need
+        to be kept around.
+        """
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("GraphINN.compile_forward requires "
+                               "torch.compile (PyTorch 2.0 or newer).")
+        x_or_z, c = self._parse_forward_args(example_inputs, example_c, rev)
+        self._compiled_forwards[self._compile_key(x_or_z, c, rev, jac)] = \
+            torch.compile(self._fx_forward(rev, jac), mode="reduce-overhead",
+                          fullgraph=False, dynamic=False)
+
+    def capture_cuda_graph(self, example_inputs: Union[Tensor,
+                                                       Iterable[Tensor]],
+                           example_c: Iterable[Tensor] = None,
+                           rev: bool = False, jac: bool = True):
+        """
+        Captures the computation of the whole net for CUDA inputs and
+        conditions shaped like the given examples in a torch.cuda.CUDAGraph,
+        and returns a callable (x_or_z, c) that replays it on new data.
+
+        Replaying removes all Python and kernel launch overhead, but shapes,
+        `rev` and `jac` are fixed at capture time, as are conditions that are
+        not tensors. Replaying with inputs or conditions that do not match
+        the capture raises a ValueError. The graph is captured without autograd, so this is meant
+        for inference only.
+
+        The returned callable always replays this capture, while
+        `forward_cuda_graph` replays the most recent one.
+        """
+        if not torch.cuda.is_available():
+            raise RuntimeError("GraphINN.capture_cuda_graph requires a CUDA "
+                               "device.")
+        if not hasattr(torch.cuda, "CUDAGraph"):
+            raise RuntimeError("GraphINN.capture_cuda_graph requires "
+                               "torch.cuda.CUDAGraph (PyTorch 1.10 or newer).")
+        x_or_z, c = self._parse_forward_args(example_inputs, example_c, rev)
+        for tensor in chain(x_or_z, c):
+            if torch.is_tensor(tensor) and not tensor.is_cuda:
+                raise ValueError(f"CUDA graphs can only be captured for CUDA "
+                                 f"tensors, but got a tensor on "
+                                 f"{tensor.device}.")
+        static_inputs = tuple(tensor.clone() for tensor in x_or_z)
+        static_c = tuple(tensor.clone() if torch.is_tensor(tensor) else tensor
+                         for tensor in c)
+        unchecked_forward = self._unchecked_forward(rev, jac)
+
+        with torch.no_grad():
+            # Warm up on a side stream, as required before capturing
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    unchecked_forward(static_inputs, static_c)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_outputs, static_jac = unchecked_forward(static_inputs,
+                                                               static_c)
+
+        self._cuda_graph = (graph, rev, static_inputs, static_c,
+                            static_outputs, static_jac)
+        return partial(self._replay_cuda_graph, self._cuda_graph)
+
+    def forward_cuda_graph(self, x_or_z: Union[Tensor, Iterable[Tensor]],
+                           c: Iterable[Tensor] = None) \
+            -> Tuple[Tuple[Tensor], Tensor]:
+        """
+        Replays the graph most recently recorded by `capture_cuda_graph` on
+        new inputs and conditions of the same shapes. Returns the same as
+        forward.
+        """
+        if self._cuda_graph is None:
+            raise RuntimeError("No CUDA graph was captured, call "
+                               "GraphINN.capture_cuda_graph first.")
+        return self._replay_cuda_graph(self._cuda_graph, x_or_z, c)
+
+    def _replay_cuda_graph(self, cuda_graph, x_or_z, c=None):
+        graph, rev, static_inputs, static_c, static_outputs, static_jac = \
+            cuda_graph
+
+        # copy_ broadcasts and casts, so mismatches have to be caught here
+        x_or_z, c = self._parse_forward_args(x_or_z, c, rev)
+        for i, (static_tensor, tensor) in enumerate(zip(static_inputs,
+                                                        x_or_z)):
+            self._check_cuda_graph_arg(f"Input {i}", static_tensor, tensor)
+        for i, (static_tensor, tensor) in enumerate(zip(static_c, c)):
+            self._check_cuda_graph_arg(f"Condition {i}", static_tensor,
+                                       tensor)
+
+        for static_tensor, tensor in zip(static_inputs, x_or_z):
+            static_tensor.copy_(tensor)
+        for static_tensor, tensor in zip(static_c, c):
+            if torch.is_tensor(static_tensor):
+                static_tensor.copy_(tensor)
+        graph.replay()
+
+        # The static outputs are overwritten by the next replay
+        out_list = tuple(out.clone() for out in static_outputs)
+        jacobian = static_jac.clone()
+        if len(out_list) == 1 and not self.force_tuple_output:
+            return out_list[0], jacobian
+        else:
+            return out_list, jacobian
+
+    @staticmethod
+    def _check_cuda_graph_arg(name, static_tensor, tensor):
+        """
+        Raises a ValueError if an input or condition passed for replay does
+        not match the one the CUDA graph was captured with.
+        """
+        if not torch.is_tensor(static_tensor):
+            if tensor is not static_tensor and (
+                    torch.is_tensor(tensor) or tensor != static_tensor):
+                raise ValueError(f"{name} is {tensor!r}, but the CUDA graph "
+                                 f"was captured for {static_tensor!r}, which "
+                                 f"is fixed at capture time.")
+            return
+        if not torch.is_tensor(tensor):
+            raise ValueError(f"{name} is {tensor!r}, but the CUDA graph was "
+                             f"captured for a tensor.")
+        captured = (tuple(static_tensor.shape), static_tensor.dtype,
+                    static_tensor.device)
+        given = (tuple(tensor.shape), tensor.dtype, tensor.device)
+        if given != captured:
+            raise ValueError(f"{name} has shape {given[0]}, dtype {given[1]} "
+                             f"on {given[2]}, but the CUDA graph was captured "
+                             f"for shape {captured[0]}, dtype {captured[1]} "
+                             f"on {captured[2]}.")
+
+    def _parse_forward_args(self, x_or_z, c, rev):
+        """
+        Converts inputs and conditions to tuples of tensors and checks that
+        their number matches the net.
+        """
         if torch.is_tensor(x_or_z):
             x_or_z = x_or_z,
         if torch.is_tensor(c):
             c = c,
+        if c is None:
+            c = []
 
-        jacobian = torch.zeros(x_or_z[0].shape[0]).to(x_or_z[0])
-        outs = {}
-        jacobian_dict = {} if jac else None
-
-        # Explicitly set conditions and starts
         start_nodes = self.out_nodes if rev else self.in_nodes
         if len(x_or_z) != len(start_nodes):
             raise ValueError(f"Got {len(x_or_z)} inputs, but expected "
                              f"{len(start_nodes)}.")
-        for tensor, start_node in zip(x_or_z, start_nodes):
-            outs[start_node, 0] = tensor
-
-        if c is None:
-            c = []
         if len(c) != len(self.condition_nodes):
             raise ValueError(f"Got {len(c)} conditions, but expected "
                              f"{len(self.condition_nodes)}.")
-        for tensor, condition_node in zip(c, self.condition_nodes):
-            outs[condition_node, 0] = tensor
+        return tuple(x_or_z), tuple(c)
 
-        # Go backwards through nodes if rev=True
-        for node in self.node_list[::-1 if rev else 1]:
-            # Skip all special nodes
-            if node in self.in_nodes + self.out_nodes + self.condition_nodes:
-                continue
+    @staticmethod
+    def _compile_key(x_or_z, c, rev, jac):
+        return (rev, jac, tuple(tensor.shape for tensor in x_or_z),
+                tuple(tensor.shape if torch.is_tensor(tensor) else None
+                      for tensor in c))
+
+    def _forward_impl(self, x_or_z: Tuple[Tensor], c: Tuple[Tensor],
+                      rev: bool, jac: bool, strict: bool) \
+            -> Tuple[Tuple[Tensor], Tensor]:
+        """
+        Computes the net on already parsed inputs and conditions and returns
+        the tuple of all outputs together with the log Jacobian determinant.
+        """
+        outs, jacobian = self._run_nodes(x_or_z, c, rev, jac, strict)
+        slots = self._rev_slots if rev else self._fwd_slots
+        return tuple(outs[slots[out_node, 0]] for out_node
+                     in (self.in_nodes if rev else self.out_nodes)), jacobian
+
+    def _unchecked_forward(self, rev: bool, jac: bool):
+        """
+        Returns a callable (x_or_z, c) -> (outputs, jac) that computes the net
+        without checking the module outputs: the FX graph from `_fx_forward`
+        if torch.fx is available (PyTorch 1.8 or newer), otherwise the regular
+        loop over the nodes with `strict=False`.
+        """
+        if hasattr(torch, "fx"):
+            return self._fx_forward(rev, jac)
+        return partial(self._forward_impl, rev=rev, jac=jac, strict=False)
+
+    def _fx_forward(self, rev: bool, jac: bool) -> "torch.fx.GraphModule":
+        """
+        Returns the computation of the net for fixed `rev` and `jac` as a
+        torch.fx.GraphModule with signature (x_or_z, c) -> (outputs, jac).
+        It calls all modules as straight-line code, without any checks of
+        their outputs. The graph is built on first use and then cached.
+        """
+        if (rev, jac) not in self._fx_forwards:
+            self._fx_forwards[rev, jac] = self._build_fx_forward(rev, jac)
+        return self._fx_forwards[rev, jac]
+
+    def _build_fx_forward(self, rev: bool, jac: bool) \
+            -> "torch.fx.GraphModule":
+        graph = torch.fx.Graph()
+        x_or_z = graph.placeholder("x_or_z")
+        c = graph.placeholder("c")
+        module_names = {module: f"module_list.{i}"
+                        for i, module in enumerate(self.module_list)}
+
+        # Same slot layout as in _run_nodes, holding FX nodes instead
+        slots = self._rev_slots if rev else self._fwd_slots
+        values = [None] * self._num_slots
+        start_nodes = self.out_nodes if rev else self.in_nodes
+        for i, start_node in enumerate(start_nodes):
+            values[slots[start_node, 0]] = graph.call_function(
+                operator.getitem, (x_or_z, i))
+        for i, condition_node in enumerate(self.condition_nodes):
+            values[slots[condition_node, 0]] = graph.call_function(
+                operator.getitem, (c, i))
+        jacobian = graph.call_function(
+            _zero_jacobian, (values[slots[start_nodes[0], 0]],))
+
+        mod_cs = [tuple(values[slot] for slot in cond_slots)
+                  for cond_slots in self._cond_slot_groups]
+        for node, module, cond_group, in_slots, out_slots in \
+                (self._rev_program if rev else self._fwd_program):
+            kwargs = {"rev": rev, "jac": jac}
+            if cond_group is not None:
+                kwargs["c"] = mod_cs[cond_group]
+            mod_out = graph.call_module(
+                module_names[module],
+                (tuple(values[slot] for slot in in_slots),), kwargs)
+
+            out = graph.call_function(operator.getitem, (mod_out, 0))
+            for out_idx, slot in enumerate(out_slots):
+                values[slot] = graph.call_function(operator.getitem,
+                                                   (out, out_idx))
+            if jac:
+                mod_jac = graph.call_function(operator.getitem, (mod_out, 1))
+                jacobian = graph.call_function(operator.add,
+                                               (jacobian, mod_jac))
+
+        graph.output((tuple(values[slots[out_node, 0]] for out_node
+                            in (self.in_nodes if rev else self.out_nodes)),
+                      jacobian))
+        return torch.fx.GraphModule(self, graph)
+
+    def _run_nodes(self, x_or_z: Tuple[Tensor], c: Tuple[Tensor], rev: bool,
+                   jac: bool, strict: bool, jacobian_dict: dict = None) \
+            -> Tuple[List[Tensor], Tensor]:
+        """
+        Executes all nodes in order and returns the filled list of slots and
+        the summed log Jacobian determinant. If given, `jacobian_dict`
+        receives the Jacobian of each node.
+        """
+        jacobian = x_or_z[0].new_zeros(x_or_z[0].shape[0])
+        accumulate_in_place = False
+        slots = self._rev_slots if rev else self._fwd_slots
+        outs = [None] * self._num_slots
+
+        # Explicitly set conditions and starts
+        for tensor, start_node in zip(x_or_z, (self.out_nodes if rev
+                                                else self.in_nodes)):
+            outs[slots[start_node, 0]] = tensor
+        for tensor, condition_node in zip(c, self.condition_nodes):
+            outs[slots[condition_node, 0]] = tensor
 
-            has_condition = len(node.conditions) > 0
+        mod_cs = [tuple(outs[slot] for slot in cond_slots)
+                  for cond_slots in self._cond_slot_groups]
 
-            mod_in = []
-            mod_c = []
-            for prev_node, channel in (node.outputs if rev else node.inputs):
-                mod_in.append(outs[prev_node, channel])
-            for cond_node in node.conditions:
-                mod_c.append(outs[cond_node, 0])
-            mod_in = tuple(mod_in)
-            mod_c = tuple(mod_c)
+        # Go backwards through nodes if rev=True
+        for node, module, cond_group, in_slots, out_slots in \
+                (self._rev_program if rev else self._fwd_program):
+            mod_in = tuple(outs[slot] for slot in in_slots)
 
             try:
-                if has_condition:
-                    mod_out = node.module(mod_in, c=mod_c, rev=rev, jac=jac)
+                if cond_group is not None:
+                    mod_out = module(mod_in, c=mod_cs[cond_group],
+                                     rev=rev, jac=jac)
                 else:
-                    mod_out = node.module(mod_in, rev=rev, jac=jac)
+                    mod_out = module(mod_in, rev=rev, jac=jac)
             except Exception as e:
                 raise RuntimeError(f"{node} encountered an error.") from e
 
-            out, mod_jac = self._check_output(node, mod_out, jac, rev)
+            if strict:
+                out, mod_jac = self._check_output(node, mod_out, jac, rev)
+            else:
+                out, mod_jac = mod_out
 
-            for out_idx, out_value in enumerate(out):
-                outs[node, out_idx] = out_value
+            for slot, out_value in zip(out_slots, out):
+                outs[slot] = out_value
 
             if jac:
-                jacobian = jacobian + mod_jac
-                jacobian_dict[node] = mod_jac
-
-        for out_node in (self.in_nodes if rev else self.out_nodes):
-            # This copies the one input of the out node
-            outs[out_node, 0] = outs[(out_node.outputs if rev
-                                      else out_node.inputs)[0]]
+                # The first sum creates a tensor of the final shape that no one
+                # else references, so later sums can be accumulated in place
+                if accumulate_in_place and torch.is_tensor(mod_jac) \
+                        and mod_jac.shape == jacobian.shape \
+                        and mod_jac.dtype == jacobian.dtype:
+                    jacobian.add_(mod_jac)
+                else:
+                    jacobian = jacobian + mod_jac
+                    accumulate_in_place = True
+                if jacobian_dict is not None:
+                    jacobian_dict[node] = mod_jac
 
-        if intermediate_outputs:
-            return outs, jacobian_dict
-        else:
-            out_list = [outs[out_node, 0] for out_node
-                        in (self.in_nodes if rev else self.out_nodes)]
-            if len(out_list) == 1 and not self.force_tuple_output:
-                return out_list[0], jacobian
-            else:
-                return tuple(out_list), jacobian
+        return outs, jacobian
 
     def _check_output(self, node, mod_out, jac, rev):
         if torch.is_tensor(mod_out):
@@ -362,64 +731,89 @@ class GraphINN(InvertibleModule):
                     f"Jacobian: {mod_jac}")
         return out, mod_jac
 
-    def log_jacobian_numerical(self, x, c=None, rev=False, h=1e-04):
+    def log_jacobian_numerical(self, x, c=None, rev=False, h=1e-04,
+                               max_batch_size=4096):
         """
         Approximate log Jacobian determinant via finite differences.
+
+        The inputs perturbed along several dimensions are stacked along the
+        batch axis and evaluated together, with tensor conditions repeated to
+        match. Each forward pass perturbs as many dimensions as fit into
+        `max_batch_size` samples, but at least one. If any condition is not a
+        tensor (e.g. a random seed), the perturbations are evaluated one
+        dimension at a time instead.
         """
         if isinstance(x, (list, tuple)):
             batch_size = x[0].shape[0]
-            ndim_x_separate = [np.prod(x_i.shape[1:]) for x_i in x]
+            ndim_x_separate = [x_i.shape[1:].numel() for x_i in x]
             ndim_x_total = sum(ndim_x_separate)
             x_flat = torch.cat([x_i.view(batch_size, -1) for x_i in x], dim=1)
         else:
             batch_size = x.shape[0]
-            ndim_x_total = np.prod(x.shape[1:])
+            ndim_x_total = x.shape[1:].numel()
             x_flat = x.reshape(batch_size, -1)
 
-        J_num = torch.zeros(batch_size, ndim_x_total, ndim_x_total)
-        for i in range(ndim_x_total):
-            offset = x[0].new_zeros(batch_size, ndim_x_total)
-            offset[:, i] = h
+        if torch.is_tensor(c):
+            c = c,
+        if c is None or all(torch.is_tensor(c_i) for c_i in c):
+            n_copies = min(ndim_x_total, max(1, max_batch_size // batch_size))
+        else:
+            n_copies = 1
+
+        def unflatten(x_pert):
             if isinstance(x, (list, tuple)):
-                x_upper = torch.split(x_flat + offset, ndim_x_separate, dim=1)
-                x_upper = [x_upper[i].view(*x[i].shape) for i in range(len(x))]
-                x_lower = torch.split(x_flat - offset, ndim_x_separate, dim=1)
-                x_lower = [x_lower[i].view(*x[i].shape) for i in range(len(x))]
-            else:
-                x_upper = (x_flat + offset).view(*x.shape)
-                x_lower = (x_flat - offset).view(*x.shape)
-            y_upper, _ = self.forward(x_upper, c=c, rev=rev, jac=False)
-            y_lower, _ = self.forward(x_lower, c=c, rev=rev, jac=False)
-            if isinstance(y_upper, (list, tuple)):
-                y_upper = torch.cat(
-                    [y_i.view(batch_size, -1) for y_i in y_upper], dim=1)
-                y_lower = torch.cat(
-                    [y_i.view(batch_size, -1) for y_i in y_lower], dim=1)
-            J_num[:, :, i] = (y_upper - y_lower).view(batch_size, -1) / (2 * h)
-        logdet_num = x[0].new_zeros(batch_size)
-        for i in range(batch_size):
-            logdet_num[i] = torch.slogdet(J_num[i])[1]
-
-        return logdet_num
+                x_pert = torch.split(x_pert, ndim_x_separate, dim=1)
+                return [x_pert[i].reshape(-1, *x[i].shape[1:])
+                        for i in range(len(x))]
+            return x_pert.reshape(-1, *x.shape[1:])
+
+        def flatten(y):
+            if isinstance(y, (list, tuple)):
+                return torch.cat([y_i.reshape(y_i.shape[0], -1) for y_i in y],
+                                 dim=1)
+            return y.reshape(y.shape[0], -1)
+
+        # J_num[b, :, i] is the finite difference along dimension i, filled
+        # in place chunk by chunk to avoid holding further copies of it
+        J_num = x_flat.new_empty(batch_size, ndim_x_total, ndim_x_total)
+        for start in range(0, ndim_x_total, n_copies):
+            n = min(n_copies, ndim_x_total - start)
+            # Copy i of the chunk is shifted by h along dimension start + i
+            offset = x_flat.new_zeros(n, 1, ndim_x_total)
+            index = torch.arange(n, device=x_flat.device)
+            offset[index, 0, start + index] = h
+            c_tiled = c
+            if c is not None and n > 1:
+                c_tiled = [c_i.repeat(n, *[1] * (c_i.dim() - 1)) for c_i in c]
+            with torch.no_grad():
+                y_upper, _ = self.forward(
+                    unflatten((x_flat + offset).reshape(-1, ndim_x_total)),
+                    c=c_tiled, rev=rev, jac=False)
+                y_lower, _ = self.forward(
+                    unflatten((x_flat - offset).reshape(-1, ndim_x_total)),
+                    c=c_tiled, rev=rev, jac=False)
+                diff = (flatten(y_upper) - flatten(y_lower)).reshape(
+                    n, batch_size, -1)
+            J_num[:, :, start:start + n] = diff.permute(1, 2, 0)
+        J_num.div_(2 * h)
+        return torch.slogdet(J_num)[1]
 
     def get_node_by_name(self, name) -> Optional[Node]:
         """
         Return the first node in the graph with the provided name.
         """
-        for node in self.node_list:
-            if node.name == name:
-                return node
-        return None
+        return self._node_by_name.get(name)
 
     def get_module_by_name(self, name) -> Optional[nn.Module]:
         """
         Return module of the first node in the graph with the provided name.
         """
-        node = self.get_node_by_name(name)
-        try:
-            return node.module
-        except AttributeError:
-            return None
+        node = self._node_by_name.get(name)
+        return node.module if node is not None else None
+
+
+def _zero_jacobian(x: Tensor) -> Tensor:
+    return x.new_zeros(x.shape[0])
 
 
 def topological_order(all_nodes: List[Node], in_nodes: List[InputNode],
@@ -436,26 +830,31 @@ def topological_order(all_nodes: List[Node], in_nodes: List[InputNode],
         A sorted list of nodes, where the inputs to some node in the list
         are available when all previous nodes in the list have been executed.
     """
-    # Edge dicts in both directions
-    edges_out_to_in = {node_b: {node_a for node_a, out_idx in node_b.inputs} for
-                       node_b in all_nodes + out_nodes}
-    edges_in_to_out = defaultdict(set)
-    for node_out, node_ins in edges_out_to_in.items():
-        for node_in in node_ins:
-            edges_in_to_out[node_in].add(node_out)
+    # Predecessors of each node (once per edge, so a node feeding several
+    # inputs of the same successor is listed several times), and for each
+    # node the number of outgoing edges whose target is not yet sorted
+    predecessors = {}
+    n_pending_successors = defaultdict(int)
+    for node_b in dict.fromkeys(all_nodes + out_nodes):
+        predecessors[node_b] = [node_a for node_a, out_idx in node_b.inputs]
+        for node_a in predecessors[node_b]:
+            n_pending_successors[node_a] += 1
+    n_nodes_with_inputs = sum(1 for node_as in predecessors.values()
+                              if len(node_as) > 0)
 
     # Kahn's algorithm starting from the output nodes
     sorted_nodes = []
+    n_sorted_with_inputs = 0
     no_pending_edges = deque(out_nodes)
 
     while len(no_pending_edges) > 0:
         node = no_pending_edges.popleft()
         sorted_nodes.append(node)
-        for in_node in list(edges_out_to_in[node]):
-            edges_out_to_in[node].remove(in_node)
-            edges_in_to_out[in_node].remove(node)
-
-            if len(edges_in_to_out[in_node]) == 0:
+        if len(predecessors[node]) > 0:
+            n_sorted_with_inputs += 1
+        for in_node in predecessors[node]:
+            n_pending_successors[in_node] -= 1
+            if n_pending_successors[in_node] == 0:
                 no_pending_edges.append(in_node)
 
     for in_node in in_nodes:
@@ -463,7 +862,8 @@ def topological_order(all_nodes: List[Node], in_nodes: List[InputNode],
             raise ValueError(f"Error in graph: {in_node} is not connected "
                              f"to any output.")
 
-    if sum(map(len, edges_in_to_out.values())) == 0:
+    # All edges have been visited iff every node with inputs was sorted
+    if n_sorted_with_inputs == n_nodes_with_inputs:
         return sorted_nodes[::-1]
     else:
         raise ValueError("Graph is cyclic.")
@@ -52,6 +52,95 @@ class SimpleComputeGraph(unittest.TestCase):
         self.assertEqual(in_node.output_dims, out_node.input_dims)
         self.assertEqual(graph.dims_in, in_node.output_dims)
 
+    def test_parse_inputs(self):
+
+        in_node = Ff.InputNode(4, 10)
+        split = Ff.Node(in_node, Fm.Split, {'section_sizes': [2, 2], 'dim': 0})
+        self.assertEqual(split.inputs, ((in_node, 0),))
+
+        out1 = Ff.Node((split, 1), Fm.PermuteRandom, {'seed': 0})
+        self.assertEqual(out1.inputs, ((split, 1),))
+
+        # A list of two nodes means two inputs, not one (node, idx) pair
+        out0 = Ff.Node(split.out0, Fm.PermuteRandom, {'seed': 0})
+        concat = Ff.Node([out0, out1], Fm.Concat, {'dim': 0})
+        self.assertEqual(concat.inputs, ((out0, 0), (out1, 0)))
+        self.assertEqual(concat.output_dims, [(4, 10)])
+
+        with self.assertRaises(ValueError):
+            Ff.Node(1, Fm.PermuteRandom, {'seed': 0})
+
+    def test_split_into_same_concat(self):
+
+        # Both outputs of the split feed the same concat, i.e. there are
+        # two edges between the same pair of nodes
+        in_node = Ff.InputNode(4)
+        split = Ff.Node(in_node, Fm.Split, {'section_sizes': [2, 2], 'dim': 0})
+        concat = Ff.Node([split.out0, split.out1], Fm.Concat, {'dim': 0})
+        coupling = Ff.Node(concat, Fm.GLOWCouplingBlock,
+                           {'subnet_constructor': F_fully_connected})
+        out_node = Ff.OutputNode(coupling)
+        graph = Ff.GraphINN([in_node, split, concat, coupling, out_node])
+
+        self.assertEqual(graph.node_list.count(split), 1)
+        self.assertEqual(graph.node_list.count(concat), 1)
+        self.assertLess(graph.node_list.index(split),
+                        graph.node_list.index(concat))
+
+        torch.manual_seed(0)
+        x = torch.randn(8, 4)
+        z, log_jac = graph(x)
+        self.assertEqual(z.shape, x.shape)
+
+        x_re, log_jac_rev = graph(z, rev=True)
+        self.assertTrue(torch.allclose(x, x_re, atol=1e-5))
+        self.assertTrue(torch.allclose(log_jac, -log_jac_rev, atol=1e-5))
+
+
+class BranchingComputeGraph(unittest.TestCase):
+
+    def __init__(self, *args):
+        super().__init__(*args)
+
+        torch.manual_seed(0)
+        self.batch_size = 16
+        self.x = torch.randn(self.batch_size, 6)
+
+        inp = Ff.InputNode(6, name='input')
+        split = Ff.Node(inp, Fm.Split, {'section_sizes': [2, 4], 'dim': 0}, name='split')
+        branch1 = Ff.Node(split.out0,
+                          Fm.RNVPCouplingBlock,
+                          {'subnet_constructor': F_fully_connected, 'clamp': 1.0},
+                          name='branch1')
+        branch2 = Ff.Node(split.out1,
+                          Fm.GLOWCouplingBlock,
+                          {'subnet_constructor': F_fully_connected, 'clamp': 1.0},
+                          name='branch2')
+        concat = Ff.Node([branch2.out0, branch1.out0], Fm.Concat, {'dim': 0}, name='concat')
+        out = Ff.OutputNode(concat, name='output')
+
+        self.nodes = split, branch1, branch2, concat
+        self.test_net = Ff.GraphINN([inp, split, branch1, branch2, concat, out])
+
+    def test_matches_sequential(self):
+
+        split, branch1, branch2, concat = self.nodes
+        y, j = self.test_net(self.x)
+
+        # The same computation, module by module
+        (a, b), j_split = split.module([self.x])
+        (a,), j1 = branch1.module([a])
+        (b,), j2 = branch2.module([b])
+        (y_seq,), j_concat = concat.module([b, a])
+
+        self.assertTrue(torch.allclose(y, y_seq), "Branched output differs")
+        self.assertTrue(torch.allclose(j, j_split + j1 + j2 + j_concat),
+                        "Branched Jacobian differs")
+
+        x_re, j_re = self.test_net(y, rev=True)
+        self.assertTrue(torch.allclose(self.x, x_re, atol=1e-5), "Branched inversion failed")
+        self.assertTrue(torch.allclose(j, -j_re, atol=1e-5), "Branched Jacobian inversion failed")
+
 
 class ComplexComputeGraph(unittest.TestCase):
 
@@ -137,6 +226,48 @@ class ComplexComputeGraph(unittest.TestCase):
         obs = torch.allclose(logdet, logdet_num, atol=np.inf, rtol=0.03)
         self.assertTrue(obs, f"Numerical Jacobian check {logdet, logdet_num}")
 
+    def test_non_strict(self):
+
+        if self.skip_all:
+            raise unittest.SkipTest("No CUDA-device found, skipping CUDA test.")
+
+        y, j = self.test_net(self.x, c=[self.cond])
+        x_re, j_re = self.test_net(y.clone(), c=[self.cond], rev=True)
+        self.test_net.strict = False
+        try:
+            y_ns, j_ns = self.test_net(self.x, c=[self.cond])
+            x_re_ns, j_re_ns = self.test_net(y.clone(), c=[self.cond], rev=True)
+        finally:
+            self.test_net.strict = True
+
+        self.assertTrue(torch.allclose(y, y_ns), "Outputs differ without checks")
+        self.assertTrue(torch.allclose(j, j_ns), "Jacobians differ without checks")
+        self.assertTrue(torch.allclose(x_re, x_re_ns), "Inverses differ without checks")
+        self.assertTrue(torch.allclose(j_re, j_re_ns), "Inverse Jacobians differ without checks")
+
+    def test_compile_forward(self):
+
+        if self.skip_all:
+            raise unittest.SkipTest("No CUDA-device found, skipping CUDA test.")
+        if not hasattr(torch, "compile"):
+            raise unittest.SkipTest("torch.compile not available, skipping test.")
+
+        with torch.no_grad():
+            y, j = self.test_net(self.x, c=[self.cond])
+            self.test_net.compile_forward(self.x, [self.cond])
+            y_comp, j_comp = self.test_net(self.x, c=[self.cond])
+            # Clone, as CUDA graph outputs are overwritten by the next call
+            y_comp, j_comp = y_comp.clone(), j_comp.clone()
+
+            # A different batch size falls back to the regular forward
+            y_small, j_small = self.test_net(self.x[:5], c=[self.cond[:5]])
+
+        self.assertEqual(len(self.test_net._compiled_forwards), 1)
+        self.assertTrue(torch.allclose(y, y_comp, atol=1e-4), "Compiled output differs")
+        self.assertTrue(torch.allclose(j, j_comp, atol=1e-4), "Compiled Jacobian differs")
+        self.assertTrue(torch.allclose(y[:5], y_small, atol=1e-5), "Fallback output differs")
+        self.assertTrue(torch.allclose(j[:5], j_small, atol=1e-5), "Fallback Jacobian differs")
+
 
 class ComplexComputeGraphCuda(ComplexComputeGraph):
 
@@ -150,5 +281,38 @@ class ComplexComputeGraphCuda(ComplexComputeGraph):
         else:
             self.skip_all = True
 
+    def test_cuda_graph(self):
+
+        if self.skip_all:
+            raise unittest.SkipTest("No CUDA-device found, skipping CUDA test.")
+
+        with torch.no_grad():
+            y, j = self.test_net(self.x, c=[self.cond])
+        forward = self.test_net.capture_cuda_graph(self.x, [self.cond])
+
+        x2 = torch.randn_like(self.x)
+        with torch.no_grad():
+            y2, j2 = self.test_net(x2, c=[self.cond])
+        y2_graph, j2_graph = forward(x2, [self.cond])
+        y_graph, j_graph = forward(self.x, [self.cond])
+
+        self.assertTrue(torch.allclose(y, y_graph, atol=1e-5), "CUDA graph output differs")
+        self.assertTrue(torch.allclose(j, j_graph, atol=1e-5), "CUDA graph Jacobian differs")
+        self.assertTrue(torch.allclose(y2, y2_graph, atol=1e-5), "CUDA graph replay output differs")
+        self.assertTrue(torch.allclose(j2, j2_graph, atol=1e-5), "CUDA graph replay Jacobian differs")
+
+        # copy_ into the static inputs would silently broadcast a single sample
+        with self.assertRaises(ValueError):
+            forward(self.x[:1], [self.cond[:1]])
+        # ... cast to the captured dtype, or copy across devices
+        with self.assertRaises(ValueError):
+            forward(self.x.double(), [self.cond])
+        with self.assertRaises(ValueError):
+            forward(self.x.cpu(), [self.cond])
+        # The capture had a tensor condition, so a non-tensor can't replace it
+        with self.assertRaises(ValueError):
+            forward(self.x, [None])
+
+
 if __name__ == '__main__':
     unittest.main()